@@ -15,18 +15,29 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import re
 import io
 import os
 import sys
 import argparse
+import atexit
 import textwrap
 import shutil
+import functools
+import operator
+import codecs
+import mmap
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import join as pjoin
 import struct
 import json
 from PIL import Image
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # TODO: Add support for JSON comments
 PROG_NAME = 'hltool'
 PROG_VERSION = '0.1.0'
@@ -41,6 +52,12 @@ PROG_HELP_EPILOG = [
 
 ENCODING = 'euc-kr'
 
+# Buffer size used when copying file contents in and out of the archive
+COPY_BUFSIZE = 1 << 20
+
+# Copy buffers are recycled instead of being allocated for every file
+_copy_bufs = queue.SimpleQueue()
+
 COL_GREEN = '\033[92m'
 COL_CYAN = '\033[96m'
 COL_YELLOW = '\033[93m'
@@ -54,7 +71,35 @@ def cli_cyan(*msg):
 def cli_yellow(*msg):
     return COL_YELLOW + ' '.join(map(str, msg)) + '\033[0m'
 
+"""
+    Progress messages are collected and written out in batches, since
+    writing every line separately costs a syscall each. Whatever is left
+    gets flushed on exit.
+"""
+LOG_BATCH_SIZE = 64
+_log_buf = []
+log_fd = sys.stdout
+
+# Used when stdout carries the archive itself
+def log_to_stderr():
+    global log_fd
+    log_fd = sys.stderr
+
+def log(*msg):
+    _log_buf.append(' '.join(map(str, msg)) + '\n')
+    if len(_log_buf) >= LOG_BATCH_SIZE:
+        flush_log()
+
+def flush_log():
+    if _log_buf:
+        log_fd.write(''.join(_log_buf))
+        log_fd.flush()
+        _log_buf.clear()
+
+atexit.register(flush_log)
+
 def die(*msg):
+    flush_log()
     if len(msg) == 0:
         exit(1)
 
@@ -64,6 +109,8 @@ def die(*msg):
 n_warn = 0
 def warn(*msg):
     global n_warn
+    # Keep the warning after the progress messages leading up to it
+    flush_log()
     print(cli_yellow(*msg), file=sys.stderr)
     n_warn += 1
 
@@ -71,8 +118,11 @@ def warn(*msg):
     Creates a new directory if it doesn't exist
 """
 def mkdir(path):
-    if not os.path.exists(path):
+    # Other worker processes might be creating the same directory
+    try:
         os.mkdir(path)
+    except FileExistsError:
+        pass
 
 """
     Read exactly size bytes from fd
@@ -88,6 +138,88 @@ def strict_read(fd, size, ignore_error=False):
 
     return buffer
 
+"""
+    Maps the whole content of fd into memory for reading
+    If fd can't be mapped (e.g. pipes or empty files), read everything
+    into a bytes object instead.
+"""
+def map_file(fd):
+    try:
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return fd.read()
+
+    # The mapping is read from start to end, so the kernel can read ahead
+    # more aggressively
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        buf.madvise(mmap.MADV_SEQUENTIAL)
+
+    return buf
+
+"""
+    Tells the kernel that fd is going to be read sequentially
+    This is only a hint, nothing happens if it's not supported.
+"""
+def advise_sequential(fd):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        # e.g. fd is a pipe
+        pass
+
+"""
+    In-memory copy of a file, read with a single read call
+    Resource files are small and get parsed with lots of tiny reads, which
+    are a lot cheaper from memory than from a file. The file name is kept
+    for error messages.
+"""
+class BufferReader(io.BytesIO):
+    def __init__(self, fd):
+        super().__init__(fd.read())
+        self.name = fd.name
+
+    def __repr__(self):
+        return '<BufferReader name=%r>' % self.name
+
+"""
+    Makes sure buf holds at least size bytes at offset, raising the same
+    error as strict_read otherwise
+    Returns the offset right after those bytes.
+"""
+def check_slice(buf, offset, size):
+    end = offset + size
+    if end > len(buf):
+        raise IOError('There is not enough bytes to read. Expecting %d bytes, got %d bytes. Probably due to malformed data at %d' % (size, len(buf) - offset, offset))
+
+    return end
+
+"""
+    Same as strict_read, but slices exactly size bytes from buf at offset
+    Returns a tuple of the slice and the offset right after it
+"""
+def strict_slice(buf, offset, size):
+    end = check_slice(buf, offset, size)
+    return buf[offset:end], end
+
+"""
+    JSON reading/writing utilities for the decoded resource files
+    These work on binary file descriptors. orjson is used if it's installed,
+    as it's a lot faster than json, especially when pretty-printing.
+"""
+def dump_json(obj, fd):
+    if orjson:
+        fd.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        fd.write(json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8'))
+
+def load_json(fd):
+    if orjson:
+        return orjson.loads(fd.read())
+    return json.load(fd)
+
 class Processor:
     def __init__(self, name, wdir, target_list, no_json=False, quiet=False):
         self.name = name
@@ -98,53 +230,55 @@ class Processor:
 
     def log(self, *msg):
         if not self.quiet:
-            print(cli_cyan('[%s]') % self.name, *msg, flush=True)
+            log(cli_cyan('[%s]') % self.name, *msg)
 
     @staticmethod
     def convert_target_name(name):
         return os.path.basename(name) + '.json'
 
     def _assemble(self):
-        mkdir(self.wdir)
-
         for target in self.target_list:
-            self.log('Assemble:', target)
-
-            in_obj = None
-            out_fd = None
-            if not self.no_json:
-                in_fd = open(pjoin(self.wdir,
-                                   self.convert_target_name(target)),
-                             'r')
-                in_obj = json.load(in_fd)
-
-            out_fd = open(pjoin('.tmp', target), 'wb')
+            self._assemble_target(target)
 
+    def _assemble_target(self, target):
+        mkdir(self.wdir)
+        self.log('Assemble:', target)
+
+        in_obj = None
+        if not self.no_json:
+            with open(pjoin(self.wdir, self.convert_target_name(target)),
+                      'rb') as in_fd:
+                in_obj = load_json(in_fd)
+
+        # The file in .tmp is hard linked to its raw copy, unlink it first
+        # so that we don't write through the link into the raw copy
+        out_path = pjoin('.tmp', target)
+        try:
+            os.unlink(out_path)
+        except FileNotFoundError:
+            pass
+        with open(out_path, 'wb') as out_fd:
             chdir_wrap(self.wdir,
                        lambda: self.assemble(in_obj, out_fd))
 
-            out_fd.close()
-            if not self.no_json:
-                in_fd.close()
-
     def _disassemble(self):
+        for target in self.target_list:
+            self._disassemble_target(target)
+
+    def _disassemble_target(self, target):
         mkdir(self.wdir)
+        self.log('Disassemble:', target)
 
-        target_list = self.target_list
-        for target in target_list:
-            self.log('Disassemble:', target)
-            in_fd = open(pjoin('raw', target), 'rb')
-            if not self.no_json:
-                out_fd = open(pjoin(self.wdir,
-                                    self.convert_target_name(target)),
-                              'w')
+        with open(pjoin('raw', target), 'rb') as raw_fd:
+            in_fd = BufferReader(raw_fd)
 
+        with in_fd:
             out_obj = chdir_wrap(self.wdir, lambda: self.disassemble(in_fd))
-            if not self.no_json:
-                json.dump(out_obj, out_fd, indent=4, ensure_ascii=False)
-                out_fd.close()
 
-            in_fd.close()
+        if not self.no_json:
+            with open(pjoin(self.wdir, self.convert_target_name(target)),
+                      'wb') as out_fd:
+                dump_json(out_obj, out_fd)
 
     def assemble(self, in_obj, out_fd):
         raise NotImplementedError('Must implement assemble')
@@ -152,40 +286,49 @@ class Processor:
     def disassemble(self, in_fd):
         raise NotImplementedError('Must implement disassemble')
 
+"""
+    Returns a compiled struct.Struct for format
+    Compiled structs are cached so that the format string is only parsed once.
+"""
+@functools.lru_cache(maxsize=256)
+def get_struct(format):
+    return struct.Struct(format)
+
 def read_struct(fd, format, ignore_error=False):
-    read_size = struct.calcsize(format)
-    buffer = strict_read(fd, read_size, ignore_error=ignore_error)
-    if buffer == None:
+    s = get_struct(format)
+    buffer = strict_read(fd, s.size, ignore_error=ignore_error)
+    if buffer is None:
         return None
-    return struct.unpack(format, buffer)
+    return s.unpack(buffer)
 
 def write_struct(fd, format, *fields):
-    data = struct.pack(format, *fields)
+    data = get_struct(format).pack(*fields)
     return fd.write(data)
 
 """
     Integer reading/writing utilities
 """
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+
 def read_le32(fd):
-    b = read_struct(fd, '<I')
-    return b[0]
+    return _U32.unpack(strict_read(fd, 4))[0]
 
 def write_le32(fd, val):
-    return write_struct(fd, '<I', val)
+    return fd.write(_U32.pack(val))
 
 def read_le16(fd):
-    b = read_struct(fd, '<H')
-    return b[0]
+    return _U16.unpack(strict_read(fd, 2))[0]
 
 def write_le16(fd, val):
-    return write_struct(fd, '<H', val)
+    return fd.write(_U16.pack(val))
 
 def read_le8(fd):
-    b = read_struct(fd, '<B')
-    return b[0]
+    return _U8.unpack(strict_read(fd, 1))[0]
 
 def write_le8(fd, val):
-    return write_struct(fd, '<B', val)
+    return fd.write(_U8.pack(val))
 
 """
     Read from fd a string table with structure as described below.
@@ -200,20 +343,30 @@ def write_le8(fd, val):
 """
 def read_strtab(fd):
     str_count = read_le32(fd)
-    
+
     strings = []
-    for _ in range(str_count):
-        tmp = b''
-        # Since we don't know the length in advance, read until we bump
-        # into a NULL terminator. This is inefficient, but with the scale
-        # of the things we're dealing with, this is good enough.
-        while True:
-            char = strict_read(fd, 1)
-            if char[0] == 0:
-                strings.append(tmp.decode(encoding='ascii'))
-                break
-
-            tmp += char
+    # Since we don't know the length in advance, read the table in large
+    # chunks and split the strings out of them
+    buf = bytearray()
+    pos = 0
+    while len(strings) < str_count:
+        null_idx = buf.find(0, pos)
+        if null_idx == -1:
+            # Drop the strings we already have and read some more
+            del buf[:pos]
+            pos = 0
+
+            chunk = fd.read(65536)
+            if len(chunk) == 0:
+                raise IOError('String table ended after %d out of %d strings. Probably due to malformed data at %d fd %s' % (len(strings), str_count, fd.tell(), fd))
+            buf += chunk
+            continue
+
+        strings.append(buf[pos:null_idx].decode(encoding='ascii'))
+        pos = null_idx + 1
+
+    # Seek fd to the first byte after the string table
+    fd.seek(pos - len(buf), os.SEEK_CUR)
 
     return strings
 
@@ -221,13 +374,28 @@ def write_strtab(fd, strings, encoding='utf-8'):
     nstr = len(strings)
     write_le32(fd, nstr)
 
-    for s in strings:
-        fd.write(bytes(s, encoding) + b'\x00')
+    fd.write(b''.join(bytes(s, encoding) + b'\x00' for s in strings))
+
+"""
+    Game strings tend to repeat a lot (item types, names, etc.), so
+    successful conversions are cached. Failed conversions are not cached,
+    which means they still get warned about every time.
+"""
+_encoder = codecs.getencoder(ENCODING)
+_decoder = codecs.getdecoder(ENCODING)
+
+@functools.lru_cache(maxsize=4096)
+def _encode_str_cached(s):
+    return _encoder(s)[0]
+
+@functools.lru_cache(maxsize=4096)
+def _decode_str_cached(b):
+    return _decoder(b)[0]
 
 def encode_str(s):
     try:
-        b = s.encode(encoding=ENCODING)
-    except UnicodeDecodeError:
+        b = _encode_str_cached(s)
+    except UnicodeEncodeError:
         warn('Unable to encode string: %s using encoding %s. The result might look slightly malformed.' % (s, ENCODING))
         b = s.encode(encoding=ENCODING, errors='ignore')
 
@@ -235,7 +403,7 @@ def encode_str(s):
 
 def decode_str(b):
     try:
-        s = b.decode(encoding=ENCODING)
+        s = _decode_str_cached(b)
     except UnicodeDecodeError:
         warn('Unable to decode bytes: %s using encoding %s. The result might look slightly malformed.' % (b, ENCODING))
         s = b.decode(encoding=ENCODING, errors='ignore')
@@ -251,38 +419,25 @@ def read_pascal_str(fd):
     return string
 
 def write_pascal_str(fd, string):
-    string_b = encode_str(string)
-    strsize = len(string_b)
-    write_le8(fd, strsize)
-    return fd.write(string_b) + 1
+    return fd.write(pack_pascal_str(string))
 
 """
-    Read a NULL-terminated string
+    Encode a string as a pascal string, length byte included
 """
-def read_str(fd):
-    str_c = []
-
-    while True:
-        buf = fd.read(256)
-        if len(buf) == 0:
-            break
-
-        found_null = False
-        left = len(buf)
-        for c in buf:
-            left -= 1
-            if c == 0:
-                found_null = True
-                break
-            else:
-                str_c.append(c)
+def pack_pascal_str(string):
+    string_b = encode_str(string)
+    return _U8.pack(len(string_b)) + string_b
 
-        if found_null:
-            # Seek fd to the first byte after the previous NULL-terminator
-            fd.seek(-left, os.SEEK_CUR)
-            break
+"""
+    Decode a NULL-terminated string from the start of buf
+"""
+def read_str_from(buf):
+    str_b = bytes(buf)
+    null_idx = str_b.find(b'\x00')
+    if null_idx != -1:
+        str_b = str_b[:null_idx]
 
-    return decode_str(bytes(str_c))
+    return decode_str(str_b)
 
 """
     Write a NULL-terminated string
@@ -313,58 +468,90 @@ def write_str(fd, string):
     Use wide_spec=True if the array uses 32-bit length specifier.
     Use pass_idx=True to pass the current index to the callback
     as a second argument.
+    Use raw=True to pass the element's data as bytes instead of a
+    temporary file descriptor.
 
     On success, it returns a list of the return values of each call to
     read_cb.
 """
-def read_pascal_array(fd, read_cb, wide_spec=False, pass_idx=False):
+def read_pascal_array(fd, read_cb, wide_spec=False, pass_idx=False, raw=False):
     ret_vals = []
     n_elem = read_le32(fd) if wide_spec else read_le16(fd)
 
     for i in range(n_elem):
         datalen = read_le32(fd) if wide_spec else read_le16(fd)
 
-        tmp_fd = io.BytesIO(strict_read(fd, datalen))
+        data = strict_read(fd, datalen)
+        tmp_fd = data if raw else io.BytesIO(data)
         if pass_idx:
             ret_vals.append(read_cb(tmp_fd, i))
         else:
             ret_vals.append(read_cb(tmp_fd))
-        tmp_fd.close()
+        if not raw:
+            tmp_fd.close()
 
     return ret_vals
 
-def write_pascal_array(fd, write_cb, elements, wide_spec=False, pass_idx=False):
-    total_bytes_written = 0
+"""
+    Write array to fd with the structure described in read_pascal_array
 
-    n_elem = len(elements)
-    if wide_spec:
-        write_le32(fd, n_elem)
-        total_bytes_written += 4
-    else:
-        write_le16(fd, n_elem)
-        total_bytes_written += 2
+    This function calls write_cb for every element with a temporary file
+    descriptor to write the element's data into as its first argument and
+    the element as its second argument.
 
-    for e in elements:
-        start_pos = fd.tell()
-        fd.seek(4 if wide_spec else 2, os.SEEK_CUR)
-        total_bytes_written += 4 if wide_spec else 2
+    Use wide_spec=True if the array uses 32-bit length specifier.
+    Use pass_idx=True to pass the current index to the callback
+    as a third argument.
+    Use raw=True if write_cb takes only the element and returns its data
+    as bytes instead.
 
-        if pass_idx:
-            bytes_written = write_cb(fd, e, i)
+    On success, it returns the number of bytes written.
+"""
+def write_pascal_array(fd, write_cb, elements, wide_spec=False, pass_idx=False, raw=False):
+    len_struct = _U32 if wide_spec else _U16
+    # The whole array is assembled in memory and written at once
+    parts = [len_struct.pack(len(elements))]
+
+    for i, e in enumerate(elements):
+        if raw:
+            data = write_cb(e, i) if pass_idx else write_cb(e)
         else:
-            bytes_written = write_cb(fd, e)
+            # Write the element into a temporary buffer first, so that its
+            # length is known before it's written
+            tmp_fd = io.BytesIO()
+            if pass_idx:
+                write_cb(tmp_fd, e, i)
+            else:
+                write_cb(tmp_fd, e)
+            data = tmp_fd.getvalue()
+            tmp_fd.close()
 
-        fd.seek(start_pos, os.SEEK_SET)
-        if wide_spec:
-            write_le32(fd, bytes_written)
-        else:
-            write_le16(fd, bytes_written)
-        fd.seek(bytes_written, os.SEEK_CUR)
+        parts.append(len_struct.pack(len(data)))
+        parts.append(data)
 
-        total_bytes_written += bytes_written
+    return fd.write(b''.join(parts))
 
-    return total_bytes_written
+"""
+    Read extended array from fd with structure as described below:
+    |--------------------------
+    | n_elements
+    | elem_1_length
+    | elem_2_length
+    | ....
+    | elem_1_data
+    | elem_2_data
+    | ....
+    |--------------------------
+
+    lspec_size is the size of each length specifier, 1 for 8-bit and
+    2 for 16-bit.
+
+    This function calls read_cb for every element of the array with a
+    memoryview of the element's data as its only argument.
 
+    On success, it returns a list of the return values of each call to
+    read_cb.
+"""
 def read_ext_array(fd, read_cb, lspec_size):
     lspec_fmt = '<%dH' if lspec_size == 2 else '<%dB'
 
@@ -372,10 +559,13 @@ def read_ext_array(fd, read_cb, lspec_size):
     n_elem = read_le8(fd)
 
     len_list = read_struct(fd, lspec_fmt % n_elem)
+
+    # Read the data of every element at once and slice it up
+    data = memoryview(strict_read(fd, sum(len_list)))
+    offset = 0
     for l in len_list:
-        tmp_fd = io.BytesIO(strict_read(fd, l))
-        ret_vals.append(read_cb(tmp_fd))
-        tmp_fd.close()
+        ret_vals.append(read_cb(data[offset:offset + l]))
+        offset += l
 
     return ret_vals
 
@@ -383,46 +573,127 @@ def write_ext_array(fd, write_cb, lspec_size, elements):
     n_elem = len(elements)
     lspec_fmt = '<%dH' % n_elem if lspec_size == 2 else '<%dB' % n_elem
 
-    write_le8(fd, n_elem)
-    lspec_pos = fd.tell()
-    fd.seek(struct.calcsize(lspec_fmt), io.SEEK_CUR)
-    
-    len_list = []
+    data_list = []
     for e in elements:
-        bytes_written = write_cb(fd, e)
-        len_list.append(bytes_written)
-    
-    total_bytes_written = sum(len_list)
+        tmp_fd = io.BytesIO()
+        write_cb(tmp_fd, e)
+        data_list.append(tmp_fd.getvalue())
+        tmp_fd.close()
 
-    fd.seek(lspec_pos, os.SEEK_SET)
-    write_struct(fd, lspec_fmt, *len_list)
-    fd.seek(total_bytes_written, os.SEEK_CUR)
+    len_list = [len(data) for data in data_list]
 
-def reorder_dict(unordered_dict, key_order):
-    # Make sure that the key in key_order is exactly the same as in dict
-    assert(set(unordered_dict) == set(key_order))
-    return {k: unordered_dict[k] for k in key_order}
+    # Element count, length specifiers, then the elements themselves
+    return fd.write(_U8.pack(n_elem)
+                    + get_struct(lspec_fmt).pack(*len_list)
+                    + b''.join(data_list))
 
 class SimpleStruct:
     def __init__(self, struct_dict, key_order=None):
         assert(isinstance(struct_dict, dict))
         self.struct_dict = struct_dict
-        self.key_order = key_order
+        self.key_order = None
+        if key_order:
+            # Make sure that the key in key_order is exactly the same as in dict
+            assert(set(struct_dict) == set(key_order))
+            self.key_order = tuple(key_order)
+        self.layout = self.compile_layout(struct_dict)
+
+        # If every field is a fixed size Int, the whole struct is read and
+        # written with a single Struct
+        self.fixed_struct = None
+        if len(self.layout) == 1 and isinstance(self.layout[0][0], tuple):
+            self.fixed_struct = self.layout[0][1]
+
+        # Values are read in the order of struct_dict. If key_order asks for
+        # another order, they are shuffled into it by index, which is a lot
+        # faster than building the dict twice.
+        self.out_keys = self.key_order or tuple(struct_dict)
+        self.reorder = None
+        if self.out_keys != tuple(struct_dict):
+            index = {k: i for i, k in enumerate(struct_dict)}
+            self.reorder = operator.itemgetter(*[index[k] for k in self.out_keys])
+
+    """
+        Merges every run of consecutive Int fields sharing the same byteorder
+        into a single struct.Struct, so that the whole run can be decoded
+        with one unpack_from call.
+
+        Returns a list of (key, field) pairs for the fields that can't be
+        merged, and (keys, Struct) pairs for the merged runs, with keys
+        being a tuple.
+    """
+    @staticmethod
+    def compile_layout(struct_dict):
+        layout = []
+        run_keys = []
+        run_fmt = ''
+
+        for k, v in struct_dict.items():
+            if isinstance(v, Int) and v.struct:
+                fmt = v.struct.format
+                # Byteorder changed, start a new run
+                if run_keys and run_fmt[0] != fmt[0]:
+                    layout.append((tuple(run_keys), struct.Struct(run_fmt)))
+                    run_keys = []
+
+                if not run_keys:
+                    run_fmt = fmt[0]
+                run_keys.append(k)
+                run_fmt += fmt[1:]
+            else:
+                if run_keys:
+                    layout.append((tuple(run_keys), struct.Struct(run_fmt)))
+                    run_keys = []
+                layout.append((k, v))
+
+        if run_keys:
+            layout.append((tuple(run_keys), struct.Struct(run_fmt)))
+
+        return layout
+
+    def make_dict(self, values):
+        if self.reorder:
+            values = self.reorder(values)
+        return dict(zip(self.out_keys, values))
 
     def read(self, fd):
-        ret = {}
-        for k, v in self.struct_dict.items():
-            ret[k] = v.read(fd)
+        if self.fixed_struct:
+            return self.make_dict(self.fixed_struct.unpack(
+                strict_read(fd, self.fixed_struct.size)))
+
+        values = []
+        for k, v in self.layout:
+            if isinstance(k, tuple):
+                values += v.unpack(strict_read(fd, v.size))
+            else:
+                values.append(v.read(fd))
+
+        return self.make_dict(values)
 
-        if self.key_order:
-            ret = reorder_dict(ret, self.key_order)
+    def read_from(self, buf, offset=0):
+        values = []
+        for k, v in self.layout:
+            if isinstance(k, tuple):
+                end = check_slice(buf, offset, v.size)
+                values += v.unpack_from(buf, offset)
+                offset = end
+            else:
+                value, offset = v.read_from(buf, offset)
+                values.append(value)
 
-        return ret
+        return self.make_dict(values), offset
 
     def write(self, fd, in_obj):
+        if self.fixed_struct:
+            keys, _ = self.layout[0]
+            return fd.write(self.fixed_struct.pack(*[in_obj[k] for k in keys]))
+
         bytes_written = 0
-        for k, v in self.struct_dict.items():
-            bytes_written += v.write(fd, in_obj[k])
+        for k, v in self.layout:
+            if isinstance(k, tuple):
+                bytes_written += fd.write(v.pack(*[in_obj[key] for key in k]))
+            else:
+                bytes_written += v.write(fd, in_obj[k])
 
         return bytes_written
 
@@ -433,30 +704,17 @@ class SimpleStruct:
 class PascalArray:
     def __init__(self, struct_dict, key_order=None):
         assert(isinstance(struct_dict, dict))
-        self.struct_dict = struct_dict
-        self.key_order = key_order
-
-    def read(self, fd):
-        def read_func(in_fd):
-            item = {}
-            for k, v in self.struct_dict.items():
-                item[k] = v.read(in_fd)
-            
-            if self.key_order:
-                item = reorder_dict(item, self.key_order)
+        self.elem_struct = SimpleStruct(struct_dict, key_order)
 
-            return item
+    def read_elem(self, buf):
+        item, _ = self.elem_struct.read_from(buf)
+        return item
 
-        return read_pascal_array(fd, read_func)
+    def read(self, fd):
+        return read_pascal_array(fd, self.read_elem, raw=True)
 
     def write(self, fd, in_obj):
-        def write_func(in_fd, item):
-            bytes_written = 0
-            for k, v in self.struct_dict.items():
-                bytes_written += v.write(fd, item[k])
-            return bytes_written
-
-        return write_pascal_array(fd, write_func, in_obj)
+        return write_pascal_array(fd, self.elem_struct.write, in_obj)
 
 class PascalStr:
     def read(self, fd):
@@ -468,26 +726,40 @@ class PascalStr:
 
         return string
 
+    def read_from(self, buf, offset):
+        strlen, offset = strict_slice(buf, offset, 1)
+        string_b, offset = strict_slice(buf, offset, strlen[0])
+        return decode_str(string_b), offset
+
     def write(self, fd, string):
-        string_b = encode_str(string)
-        strsize = len(string_b)
-        write_le8(fd, strsize)
-        return fd.write(string_b) + 1
+        return write_pascal_str(fd, string)
 
 class Data:
     def __init__(self, size=None):
         self.size = size
 
     def read(self, fd):
-        if self.size == None:
+        if self.size is None:
             return list(fd.read())
         else:
             return list(strict_read(fd, self.size))
 
+    def read_from(self, buf, offset):
+        if self.size is None:
+            return list(buf[offset:]), len(buf)
+        else:
+            data, offset = strict_slice(buf, offset, self.size)
+            return list(data), offset
+
     def write(self, fd, in_obj):
         return fd.write(bytes(in_obj))
 
 class Int:
+    # struct format characters (unsigned, signed) for the integer widths
+    # struct can handle natively, anything else goes through
+    # int.from_bytes/int.to_bytes
+    FORMATS = {8: 'Bb', 16: 'Hh', 32: 'Ii', 64: 'Qq'}
+
     def __init__(self, bits, byteorder='little', signed=False):
         if byteorder != 'little' and byteorder != 'big':
             raise ValueError('Byteorder must be either "little" or "big"')
@@ -497,42 +769,152 @@ class Int:
         self.byteorder = byteorder
         self.bits = bits
         self.signed = signed
+        self.size = bits // 8
+
+        self.struct = None
+        if bits in self.FORMATS:
+            self.struct = struct.Struct(('<' if byteorder == 'little' else '>')
+                                        + self.FORMATS[bits][signed])
 
     def read(self, fd):
-        struct_fmt = '%dB' % (self.bits // 8)
-        ints = read_struct(fd, struct_fmt)
-        return int.from_bytes(bytes(ints), byteorder=self.byteorder,
-                              signed=self.signed)
+        if self.struct:
+            return self.struct.unpack(strict_read(fd, self.size))[0]
+
+        return int.from_bytes(strict_read(fd, self.size),
+                              byteorder=self.byteorder, signed=self.signed)
+
+    def read_from(self, buf, offset):
+        if self.struct:
+            end = check_slice(buf, offset, self.size)
+            return self.struct.unpack_from(buf, offset)[0], end
+
+        data, offset = strict_slice(buf, offset, self.size)
+        return int.from_bytes(data, byteorder=self.byteorder,
+                              signed=self.signed), offset
 
     def write(self, fd, in_obj):
-        ints = int.to_bytes(in_obj, length=self.bits // 8,
+        if self.struct:
+            return fd.write(self.struct.pack(in_obj))
+
+        ints = int.to_bytes(in_obj, length=self.size,
                             byteorder=self.byteorder,
                             signed=self.signed)
         return fd.write(ints)
 
 """
-    Recursively lists all files under @path
+    Recursively lists all files under @path as (path, size) tuples
+    Paths are returned relative to @path, with @prefix prepended to them.
 """
-def list_files_recursive(path='.'):
+def list_files_recursive(path='.', prefix=''):
     files = []
-    entries = os.listdir(path)
-    for entry in entries:
-        if os.path.isdir(pjoin(path, entry)):
-            subdir_files = list_files_recursive(pjoin(path, entry))
-            files.extend([pjoin(entry, f) for f in subdir_files])
-        else:
-            files.append(entry)
+    # scandir gets the entry types along with the names, so we don't have
+    # to stat every entry to find out if it's a directory
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name = pjoin(prefix, entry.name)
+            if entry.is_dir():
+                files.extend(list_files_recursive(entry.path, name))
+            else:
+                files.append((name, entry.stat().st_size))
     return files
 
 """
-    Calculates file descriptor size relative to seek position 0
+    Opens directory @path so that files under it can be opened with
+    dir_opener, without having to chdir into it
+    Returns None if the platform doesn't support opening files relative
+    to a directory descriptor.
+"""
+def open_dir(path):
+    if os.open not in os.supports_dir_fd:
+        return None
+    return os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+
+"""
+    Returns an opener for open() that resolves paths relative to @dir_fd
+"""
+def dir_opener(dir_fd):
+    # os.open defaults to 0o777, use the same mode as open() does
+    return functools.partial(os.open, mode=0o666, dir_fd=dir_fd)
+
+"""
+    Opener for files that are only read, which asks the kernel not to
+    update their access time
+    O_NOATIME is only allowed on files we own, other files are opened
+    normally.
 """
-def get_file_size(fd):
-    prev_pos = fd.tell()
-    fd.seek(0, os.SEEK_END)
-    size = fd.tell()
-    fd.seek(prev_pos, os.SEEK_SET)
-    return size
+def noatime_opener(path, flags, dir_fd=None):
+    noatime = getattr(os, 'O_NOATIME', 0)
+    if noatime:
+        try:
+            return os.open(path, flags | noatime, dir_fd=dir_fd)
+        except PermissionError:
+            pass
+    return os.open(path, flags, dir_fd=dir_fd)
+
+"""
+    Creates a hard link dst pointing to src
+    Falls back to copying src if it can't be linked, e.g. because dst is on
+    another filesystem.
+"""
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+"""
+    Copies size bytes from the current position of in_fd to out_fd
+    When both are real files, the copy is done by the kernel using
+    os.sendfile, so the data never passes through userspace. Small copies
+    aren't worth the extra flush of out_fd and are copied normally.
+"""
+def copy_file_data(in_fd, out_fd, size):
+    if size >= COPY_BUFSIZE and hasattr(os, 'sendfile'):
+        try:
+            in_fileno = in_fd.fileno()
+            out_fileno = out_fd.fileno()
+        except (AttributeError, OSError):
+            in_fileno = None
+
+        if in_fileno is not None:
+            # Whatever is still buffered must land in out_fd first
+            out_fd.flush()
+
+            offset = in_fd.tell()
+            try:
+                sent = os.sendfile(out_fileno, in_fileno, offset, size)
+            except OSError:
+                # Not supported for this kind of files, e.g. out_fd is not
+                # a socket on some platforms. Fall back to a normal copy.
+                sent = None
+
+            if sent is not None:
+                while sent < size:
+                    n = os.sendfile(out_fileno, in_fileno, offset + sent,
+                                    size - sent)
+                    if n == 0:
+                        raise IOError('There is not enough bytes to read. Expecting %d bytes, got %d bytes. fd %s' % (size, sent, in_fd))
+                    sent += n
+
+                in_fd.seek(offset + size, os.SEEK_SET)
+                return
+
+    try:
+        buf = _copy_bufs.get_nowait()
+    except queue.Empty:
+        buf = bytearray(COPY_BUFSIZE)
+
+    try:
+        with memoryview(buf) as view:
+            copied = 0
+            while copied < size:
+                n = in_fd.readinto(view[:min(size - copied, len(buf))])
+                if not n:
+                    raise IOError('There is not enough bytes to read. Expecting %d bytes, got %d bytes. fd %s' % (size, copied, in_fd))
+                out_fd.write(view[:n])
+                copied += n
+    finally:
+        _copy_bufs.put(buf)
 
 class QuestProcessor(Processor):
     def __init__(self, **kwargs):
@@ -714,7 +1096,7 @@ class CommonTextProcessor(Processor):
         super().__init__('commontextproc', 'common_text', target_list, **kwargs)
 
     def assemble(self, in_obj, out_fd):
-        write_pascal_array(out_fd, write_pascal_str, in_obj)
+        write_pascal_array(out_fd, pack_pascal_str, in_obj, raw=True)
 
     def disassemble(self, in_fd):
         return read_pascal_array(in_fd, read_pascal_str)
@@ -761,12 +1143,13 @@ class ItemProcessor(Processor):
         super().__init__('itemproc', 'item', target_list, **kwargs)
 
     def init_structs(self):
-        self.struct_general = PascalArray({
+        struct_general = {
             'type_id': Int(16),
             'name': PascalStr(),
             'price': Int(32),
             'desc': PascalStr(),
-        }, ['name', 'desc', 'price', 'type_id', 'extras'])
+        }
+        key_order = ['name', 'desc', 'price', 'type_id', 'extras']
 
         struct_equipment = SimpleStruct({
             'sprite_id': Int(16),
@@ -787,39 +1170,33 @@ class ItemProcessor(Processor):
             'param_14h': Int(8)
         })
 
+        # Each group gets its own array struct with the group specific
+        # information appended as 'extras'. Groups with unknown structure
+        # keep their group specific information as raw data.
+        self.struct_default = PascalArray(dict(struct_general,
+                                               extras=Data()),
+                                          key_order)
         self.group_structs = dict.fromkeys(range(11),
-                                           struct_equipment)
+                                           PascalArray(dict(struct_general,
+                                                            extras=struct_equipment),
+                                                       key_order))
 
     @staticmethod
     def get_item_gid(fd):
-        id_match = re.match('item_([0-9]*)\\.dat',
-                            os.path.basename(fd.name))
-        assert(id_match)
-        return int(id_match.groups()[0])
+        # Item files are always named item_<gid>.dat
+        basename = os.path.basename(fd.name)
+        assert(basename.startswith('item_') and basename.endswith('.dat'))
+        return int(basename[len('item_'):-len('.dat')])
 
-    def disassemble(self, in_fd):
-        item_gid = self.get_item_gid(in_fd)
+    def get_group_struct(self, fd):
+        item_gid = self.get_item_gid(fd)
+        return self.group_structs.get(item_gid, self.struct_default)
 
-        # XXX: This looks like a hack to me, although subtle
-        if item_gid in self.group_structs:
-            self.struct_general.struct_dict['extras'] = self.group_structs[item_gid]
-        else:
-            self.struct_general.struct_dict['extras'] = Data()
-
-        item_obj = self.struct_general.read(in_fd)
-
-        return item_obj
+    def disassemble(self, in_fd):
+        return self.get_group_struct(in_fd).read(in_fd)
 
     def assemble(self, in_obj, out_fd):
-        item_gid = self.get_item_gid(out_fd)
-        
-        # XXX: This looks like a hack to me
-        if item_gid in self.group_structs:
-            self.struct_general.struct_dict['extras'] = self.group_structs[item_gid]
-        else:
-            self.struct_general.struct_dict['extras'] = Data()
-
-        self.struct_general.write(out_fd, in_obj)
+        self.get_group_struct(out_fd).write(out_fd, in_obj)
 
 """
     This class provides base functionality to work with gbm image
@@ -834,31 +1211,47 @@ class GbmImg:
         'height': Int(16)
     })
 
+    # Translation tables extracting the high and low nibble of a byte
+    HIGH_NIBBLES = bytes(b >> 4 for b in range(256))
+    LOW_NIBBLES = bytes(b & 0xf for b in range(256))
+    # Translation table moving the low nibble of a byte into its high nibble
+    TO_HIGH_NIBBLE = bytes((b & 0xf) << 4 for b in range(256))
+
+    # Lookup tables scaling 5-bit and 6-bit color channels to 8-bit and back
+    # Since the encoded color uses less than 8-bit color space, the color
+    # would appear dark in 8-bit color space. We need to maintain their
+    # proportion over their original color space somehow.
+    CH5_TO_8 = bytes(round(c * (0xff/0x1f)) for c in range(0x20))
+    CH6_TO_8 = bytes(round(c * (0xff/0x3f)) for c in range(0x40))
+    CH8_TO_5 = bytes(round(c / (0xff/0x1f)) for c in range(0x100))
+    CH8_TO_6 = bytes(round(c / (0xff/0x3f)) for c in range(0x100))
+
     def __init__(self, gbm_fd=None):
         if gbm_fd:
             self.open(gbm_fd)
 
     # TODO: color_bit and unk0 args should be in save
     def from_png(self, png_fd, color_bit, unk0):
-        # Converts pillow RGBA Image data into a list of pixel values suitable
-        # for GBM encoded as 565 RGB color.
-        def to_gbm_color(pil_imgdata):
-            def pix_to_gbm(rgba):
-                r, g, b, a = rgba
-
-                if a == 0:
-                    return 0xf81f
+        # Converts a RGBA color into a pixel value suitable for GBM encoded
+        # as 565 RGB color.
+        def pix_to_gbm(rgba):
+            r, g, b, a = rgba
 
-                r = round(r / (0xff/0x1f))
-                g = round(g / (0xff/0x3f))
-                b = round(b / (0xff/0x1f))
+            if a == 0:
+                return 0xf81f
 
-                return b & 0x1f | (g & 0x3f) << 5  | (r & 0x1f) << 11
+            r = self.CH8_TO_5[r]
+            g = self.CH8_TO_6[g]
+            b = self.CH8_TO_5[b]
 
-            return [pix_to_gbm(p) for p in pil_imgdata]
+            return b & 0x1f | (g & 0x3f) << 5  | (r & 0x1f) << 11
 
         img = Image.open(png_fd, formats=['png'])
-        imgdata = list(img.getdata())
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        # Every RGBA pixel as a single integer, so that they can be hashed
+        # cheaply
+        imgdata = memoryview(img.tobytes()).cast('I')
 
         if color_bit != 8 and color_bit != 4:
             die('color_bit must be either 4 or 8')
@@ -868,17 +1261,19 @@ class GbmImg:
         self.width = img.width
         self.height = img.height
 
-        # List of pixel values. We will convert it to a list of indices each pointing
-        # to an entry in the pallete data
-        gbm_imgdata = to_gbm_color(imgdata)
-        gbm_palette_data = list(set(gbm_imgdata))
+        # Sprites only use a handful of colors, so every distinct color is
+        # converted once instead of converting every pixel
+        rgba_to_gbm = {p: pix_to_gbm(p.to_bytes(4, sys.byteorder))
+                       for p in set(imgdata)}
+        gbm_palette_data = list(set(rgba_to_gbm.values()))
 
         if len(gbm_palette_data) > 256:
             die('PNG image %s has more than 256 colors, please use image that uses 256 colors or less' % png_fd)
 
-        # Palette to index conversion table
+        # Pixel to palette index conversion table
         p_i = dict((p, i) for i, p in enumerate(gbm_palette_data))
-        self.pixel_data = [p_i[p] for p in gbm_imgdata]
+        rgba_to_idx = {p: p_i[c] for p, c in rgba_to_gbm.items()}
+        self.pixel_data = [rgba_to_idx[p] for p in imgdata]
         self.palette_data = gbm_palette_data
 
     def open(self, gbm_fd):
@@ -900,29 +1295,19 @@ class GbmImg:
             # Which means for an image with an odd number of width, we will
             # have exactly "height" number of unused pixels.
             odd_row = width % 2 != 0
-            # Odd npixel can only be produced if both width and height are odd numbers.
-            # In the case of odd npixel, adding already odd height will make it even.
-            # Which means npixel will always be even no matter what.
-            npixel = width * height
-            if odd_row:
-                npixel += height
-
-            pixel_data = []
-            # Loop for each row
-            for _ in range(height):
-                row_data = list(read_struct(fd, '<%dB' % (npixel // height // 2)))
+            row_size = (width + 1) // 2
+            data = strict_read(fd, row_size * height)
 
-                for b in row_data:
-                    high = b >> 4
-                    low = b & 0xf
-                    pixel_data.append(high)
-                    pixel_data.append(low)
+            # Split every byte into its two nibbles, high nibble first
+            pixel_data = bytearray(len(data) * 2)
+            pixel_data[0::2] = data.translate(self.HIGH_NIBBLES)
+            pixel_data[1::2] = data.translate(self.LOW_NIBBLES)
 
-                # Remove the unused pixel
-                if odd_row:
-                    pixel_data.pop()
+            # Remove the unused pixel at the end of each row
+            if odd_row:
+                del pixel_data[row_size * 2 - 1::row_size * 2]
 
-            return pixel_data
+            return bytes(pixel_data)
 
         header = self.GBM_HEADER.read(gbm_fd)
         # The game uses the first 4 bits to specify color resolution
@@ -941,7 +1326,7 @@ class GbmImg:
         self.width = header['width']
         self.height = header['height']
         if self.color_bit == 8:
-            self.pixel_data = read_struct(gbm_fd, '<%dB' % (self.width * self.height))
+            self.pixel_data = strict_read(gbm_fd, self.width * self.height)
         elif self.color_bit == 4:
             self.pixel_data = read_4bit_pixdata(gbm_fd, self.width, self.height)
 
@@ -957,89 +1342,67 @@ class GbmImg:
         bytes_written += self.GBM_HEADER.write(gbm_fd, header)
         bytes_written += write_struct(gbm_fd, '<%dH' % len(self.palette_data), *self.palette_data)
 
+        # Pixel data is written as bytes, rather than spreading every pixel
+        # as an argument to struct.pack
         if self.color_bit == 8:
-            bytes_written += write_struct(gbm_fd, '<%dB' % len(self.pixel_data), *self.pixel_data)
+            bytes_written += gbm_fd.write(bytes(self.pixel_data))
         elif self.color_bit == 4:
-            odd_row = self.width % 2 != 0
-            npixel = len(self.pixel_data)
-
-            if not odd_row:
-                pixel_data = []
-                for i in range(npixel // 2):
-                    high, low = self.pixel_data[i*2 : (i+1)*2]
-                    pixel_data.append((high & 0xf) << 4 | (low & 0xf))
-
-                bytes_written += write_struct(gbm_fd, '<%dB' % (npixel // 2), *pixel_data)
-                return bytes_written
-
-            # Odd row
-            for i in range(self.height):
-                row_data = self.pixel_data[i*self.width : (i+1)*self.width]
-                # Add a dummy pixel to make it even
-                row_data.append(0)
-
-                pixel_data = []
-                for j in range(len(row_data) // 2):
-                    high, low = row_data[j*2 : (j+1)*2]
-                    pixel_data.append((high & 0xf) << 4 | (low & 0xf))
-
-                bytes_written += write_struct(gbm_fd, '<%dB' % (len(row_data) // 2), *pixel_data)
+            pixel_data = bytes(self.pixel_data)
+
+            # Odd row, add a dummy pixel to the end of each row to make it even
+            if self.width % 2 != 0:
+                pixel_data = b''.join(pixel_data[i:i + self.width] + b'\x00'
+                                      for i in range(0, len(pixel_data), self.width))
+
+            # Two pixels go into each byte, the first one in the high nibble.
+            # Both halves are put in place with translation tables, then
+            # combined all at once by OR-ing them as big integers.
+            high = pixel_data[0::2].translate(self.TO_HIGH_NIBBLE)
+            low = pixel_data[1::2].translate(self.LOW_NIBBLES)
+            packed = int.from_bytes(high, 'big') | int.from_bytes(low, 'big')
+
+            bytes_written += gbm_fd.write(packed.to_bytes(len(high), 'big'))
         else:
             assert(False)
         
         return bytes_written
 
+    # Convert a 16-bit GBM color into RGBA bytes. There are only 65536 of
+    # them and images share most of their colors, so results are memoized
+    # across images rather than recomputed for every palette.
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def color_to_rgba(c):
+        return bytes((GbmImg.CH5_TO_8[c >> 11 & 0x1f],
+                      GbmImg.CH6_TO_8[c >> 5 & 0x3f],
+                      GbmImg.CH5_TO_8[c & 0x1f],
+                      0 if c == 0xf81f else 255))
+
     def to_png(self, out_fd):
-        # Given palette data and pixel data, return a pillow-compatible
-        # RGBA Image data.
-        def pix_to_rgba(palette_data, pixel_data):
-            # This function converts 16-bit GBM color into RGBA
-            def to_rgba(c):
-                b = c & 0x1f
-                g = c >> 5 & 0x3f
-                r = c >> 11 & 0x1f
-                a = 0 if c == 0xf81f else 255
-
-                # Since the encoded color uses less than 8-bit color space, the color will appear
-                # dark in 8-bit color space. We need to maintain their proportion over
-                # their original color space somehow.
-                r = round(r * (0xff/0x1f))
-                g = round(g * (0xff/0x3f))
-                b = round(b * (0xff/0x1f))
-                return (r, g, b, a)
-
-            rgba_palette = [to_rgba(color) for color in palette_data]
-            rgba_pixel = [rgba_palette[idx] for idx in pixel_data]
-            return rgba_pixel
-
-        def rgba_to_bytes(rgba_data):
-            flat_list = []
-            for data in rgba_data:
-                flat_list.extend(data)
-            return bytes(flat_list)
-
-        # Convert pixel data
-        imgdata = pix_to_rgba(self.palette_data, self.pixel_data)
-        img_data = rgba_to_bytes(imgdata)
-
-        # Construct new image
-        img = Image.new('RGBA', (self.width, self.height))
-        img.frombytes(img_data)
+        # GBM images are palettized already, so construct a palette image
+        # straight from the pixel data instead of expanding every pixel to
+        # RGBA. The PNG encoder stores the palette's alpha in a tRNS chunk.
+        img = Image.frombytes('P', (self.width, self.height),
+                              bytes(self.pixel_data))
+        img.putpalette(b''.join(map(self.color_to_rgba, self.palette_data)),
+                       rawmode='RGBA')
         img.save(out_fd, format='png')
 
 class GbmProcessor(Processor):
+    # Built once, rather than every time a processor is constructed
+    TARGET_LIST = tuple(
+        ['c/map/face_%02d.gbm' % i for i in range(22)]
+        + ['c/map/fgi_%03d.gbm' % i for i in range(3)]
+        + ['c/map/obj_%03d.gbm' % i for i in range(255)]
+        + ['c/map/tile_%03d.gbm' % i for i in range(62)])
+
     def __init__(self, **kwargs):
-        target_list = ['c/map/face_%02d.gbm' % i for i in range(22)]
-        target_list += ['c/map/fgi_%03d.gbm' % i for i in range(3)]
-        target_list += ['c/map/obj_%03d.gbm' % i for i in range(255)]
-        target_list += ['c/map/tile_%03d.gbm' % i for i in range(62)]
-        super().__init__('gbmproc', 'gbm_sprites', target_list, **kwargs)
+        super().__init__('gbmproc', 'gbm_sprites', self.TARGET_LIST, **kwargs)
 
     def disassemble(self, in_fd):
-        png_fd = open(os.path.basename(in_fd.name) + '.png', 'wb')
-
         gbm_img = GbmImg(in_fd)
-        gbm_img.to_png(png_fd)
+        with open(os.path.basename(in_fd.name) + '.png', 'wb') as png_fd:
+            gbm_img.to_png(png_fd)
 
         return {
             'color_bit': gbm_img.color_bit,
@@ -1050,40 +1413,39 @@ class GbmProcessor(Processor):
         color_bit = in_obj['color_bit']
         unk0 = in_obj['unk0']
 
-        png_fd = open(os.path.basename(out_fd.name) + '.png', 'rb')
-
         gbm_img = GbmImg()
-        gbm_img.from_png(png_fd, color_bit, unk0)
+        with open(os.path.basename(out_fd.name) + '.png', 'rb') as png_fd:
+            gbm_img.from_png(png_fd, color_bit, unk0)
         gbm_img.save(out_fd)
 
 class MgrProcessor(Processor):
-    def __init__(self, **kwargs):
-        target_list = ['c/sp/img0/%03d.mgr' % i for i in range(128)]
-        target_list.pop(3)
-        target_list += ['c/sp/img1/%03d.mgr' % i for i in range(57)]
-        target_list.pop(140)
-        target_list += ['c/sp/img2/%03d.mgr' % i for i in range(49)]
-        target_list += ['c/sp/img3/%03d.mgr' % i for i in range(49)]
-        target_list += ['c/sp/img4/%03d.mgr' % i for i in range(68)]
-        target_list += ['c/sp/img5/%03d.mgr' % i for i in range(26)]
-        target_list += ['c/sp/img6/%03d.mgr' % i for i in range(17)]
-        target_list += ['c/par/pimg%02d.mgr' % i for i in range(9)]
-        target_list += ['c/img/gmenu.mgr',
-                        'c/img/icon.mgr',
-                        'c/img/menu.mgr',
-                        'c/img/shadow.mgr',
-                        'c/img/touch.mgr',
-                        'c/img/ui.mgr',
-                        'c/img/worldmap.mgr']
-        target_list += ['c/map_sp/fgi_img00.mgr',
-                        'c/map_sp/ms_img00.mgr',
-                        'c/map_sp/ms_img01.mgr',
-                        'c/map_sp/ms_img02.mgr',
-                        'c/map_sp/ms_img03.mgr',
-                        'c/map_sp/ms_img09.mgr']
+    # Built once, rather than every time a processor is constructed
+    TARGET_LIST = tuple(
+        ['c/sp/img0/%03d.mgr' % i for i in range(128) if i != 3]
+        + ['c/sp/img1/%03d.mgr' % i for i in range(57) if i != 13]
+        + ['c/sp/img2/%03d.mgr' % i for i in range(49)]
+        + ['c/sp/img3/%03d.mgr' % i for i in range(49)]
+        + ['c/sp/img4/%03d.mgr' % i for i in range(68)]
+        + ['c/sp/img5/%03d.mgr' % i for i in range(26)]
+        + ['c/sp/img6/%03d.mgr' % i for i in range(17)]
+        + ['c/par/pimg%02d.mgr' % i for i in range(9)]
+        + ['c/img/gmenu.mgr',
+           'c/img/icon.mgr',
+           'c/img/menu.mgr',
+           'c/img/shadow.mgr',
+           'c/img/touch.mgr',
+           'c/img/ui.mgr',
+           'c/img/worldmap.mgr']
+        + ['c/map_sp/fgi_img00.mgr',
+           'c/map_sp/ms_img00.mgr',
+           'c/map_sp/ms_img01.mgr',
+           'c/map_sp/ms_img02.mgr',
+           'c/map_sp/ms_img03.mgr',
+           'c/map_sp/ms_img09.mgr'])
 
+    def __init__(self, **kwargs):
         # We'll handle json processing ourselves
-        super().__init__('mgrproc', 'mgr_sprites', target_list, no_json=True, **kwargs)
+        super().__init__('mgrproc', 'mgr_sprites', self.TARGET_LIST, no_json=True, **kwargs)
 
     def disassemble(self, in_fd):
         # We should be inside self.wdir right now
@@ -1148,7 +1510,7 @@ class MgrProcessor(Processor):
     set, then the name would be "0".
 """
 class SceneProcessor(Processor):
-    HEADER_STRUCT_FMT = '<15B'
+    HEADER_STRUCT = struct.Struct('<15B')
 
     def __init__(self, **kwargs):
         target_list = ['c/map/%05d.scn' % i for i in range(218)]
@@ -1157,20 +1519,22 @@ class SceneProcessor(Processor):
                          target_list, **kwargs)
 
     def disassemble(self, in_fd):
-        header = read_struct(in_fd, self.HEADER_STRUCT_FMT)
+        header = self.HEADER_STRUCT.unpack(strict_read(in_fd,
+                                                       self.HEADER_STRUCT.size))
         # The first three bytes of the header are associated with each array and 
         # they determine the number of bits the array is using for its length
         # specifier. 1 for 8-bit, 2 for 16-bit.
         lspec_size = header[:3]
-        arr1 = read_ext_array(in_fd, lambda fd: fd.read(), lspec_size[0])
-        arr2 = read_ext_array(in_fd, lambda fd: fd.read(), lspec_size[1])
-        strings = read_ext_array(in_fd, read_str, lspec_size[2])
+        # Elements are turned into their JSON form, lists of ints, right away
+        arr1 = read_ext_array(in_fd, list, lspec_size[0])
+        arr2 = read_ext_array(in_fd, list, lspec_size[1])
+        strings = read_ext_array(in_fd, read_str_from, lspec_size[2])
 
         return {
             'strings': strings,
             'header': list(header),
-            'arr1': [list(d) for d in arr1],
-            'arr2': [list(d) for d in arr2]
+            'arr1': arr1,
+            'arr2': arr2
         }
 
     def assemble(self, in_obj, out_fd):
@@ -1212,89 +1576,140 @@ class SceneProcessor(Processor):
 """
 class VFSProcessor:
     MANIFEST_PATH_HASH = 0xbc909d54
-    HEADER_STRUCT_FMT = '<II'
+    HEADER_STRUCT = struct.Struct('<II')
 
-    def __init__(self, quiet=False):
+    def __init__(self, quiet=False, jobs=None):
         self.name = 'vfsproc'
         self.quiet = quiet
-    
+        self.jobs = jobs
+
     def log(self, *msg):
         if not self.quiet:
-            print(cli_cyan('[%s]') % self.name, *msg, flush=True)
-
-    def get_vfs_data(self, vfs_fd):
+            log(cli_cyan('[%s]') % self.name, *msg)
+
+    """
+        Indexes the archive in vfs_buf
+        Returns a dict mapping path hashes to the (start, end) offsets of the
+        file contents.
+    """
+    def get_vfs_data(self, vfs_buf):
         data = {}
-        while True:
-            header = read_struct(vfs_fd, self.HEADER_STRUCT_FMT,
-                                 ignore_error=True)
-            if header == None:
-                break
-            path_hash, file_size = header
-
-            data[path_hash] = {
-                'file_size': file_size,
-                'offset': vfs_fd.tell()
-            }
+        offset = 0
+        header_size = self.HEADER_STRUCT.size
+        while offset + header_size <= len(vfs_buf):
+            path_hash, file_size = self.HEADER_STRUCT.unpack_from(vfs_buf,
+                                                                  offset)
+            offset += header_size
 
             # Jump to the next file header
-            vfs_fd.seek(file_size, os.SEEK_CUR)
+            data[path_hash] = (offset, offset + file_size)
+            offset += file_size
 
         return data
 
-    def assemble(self, vfs_fd):
-        def append_to_vfs(_vfs_fd, _fd, fhash):
-            fsize = get_file_size(_fd)
-            write_struct(_vfs_fd, self.HEADER_STRUCT_FMT,
-                         fhash, fsize)
-            _vfs_fd.write(_fd.read())
-
-        path_list = list_files_recursive()
-        for path in path_list:
-            self.log('Packing:', path)
-
-            fd = open(path, 'rb')
-            append_to_vfs(vfs_fd, fd, self.hash(path))
-            fd.close()
-
+    def assemble(self, vfs_fd, root='.'):
+        file_list = list_files_recursive(root)
+
+        # Files are opened relative to root, the working directory is
+        # left alone
+        root_fd = open_dir(root)
+        try:
+            for path, fsize in file_list:
+                self.log('Packing:', path)
+
+                if root_fd is not None:
+                    fd = open(path, 'rb', opener=functools.partial(
+                        noatime_opener, dir_fd=root_fd))
+                else:
+                    fd = open(pjoin(root, path), 'rb', opener=noatime_opener)
+
+                with fd:
+                    vfs_fd.write(self.HEADER_STRUCT.pack(self.hash(path), fsize))
+                    copy_file_data(fd, vfs_fd, fsize)
+        finally:
+            if root_fd is not None:
+                os.close(root_fd)
+
+        # Only the manifest is built in memory, file contents are streamed
+        # straight into the archive above
         strtab_fd = io.BytesIO()
-        write_strtab(strtab_fd, path_list)
-        strtab_fd.seek(0, os.SEEK_SET)
-
-        append_to_vfs(vfs_fd, strtab_fd, self.MANIFEST_PATH_HASH)
+        write_strtab(strtab_fd, [path for path, _ in file_list])
+        with strtab_fd.getbuffer() as strtab:
+            vfs_fd.write(self.HEADER_STRUCT.pack(self.MANIFEST_PATH_HASH,
+                                                 len(strtab)))
+            vfs_fd.write(strtab)
         strtab_fd.close()
 
-    def disassemble(self, vfs_fd):
-        vfs_data = self.get_vfs_data(vfs_fd)
-
-        manifest = vfs_data[self.MANIFEST_PATH_HASH]
-        vfs_fd.seek(manifest['offset'], os.SEEK_SET)
-        filenames = read_strtab(vfs_fd)
-
-        for fname in filenames:
-            self.log('Extracting:', fname)
-
-            path_hash = self.hash(fname)
-            file = vfs_data[path_hash]
-
-            if os.path.dirname(fname) != '':
-                os.makedirs(os.path.dirname(fname), exist_ok=True)
-            
-            vfs_fd.seek(file['offset'], os.SEEK_SET)
-            file_data = vfs_fd.read(file['file_size'])
-
-            file_fd = open(os.path.relpath(fname), 'wb')
-            file_fd.write(file_data)
+    def disassemble(self, vfs_fd, root='.'):
+        # File contents are written straight from the mapping, without
+        # copying them into intermediate bytes objects
+        vfs_buf = map_file(vfs_fd)
+
+        # Files are created relative to root, the working directory is
+        # left alone
+        root_fd = open_dir(root)
+        try:
+            opener = dir_opener(root_fd) if root_fd is not None else None
+
+            with memoryview(vfs_buf) as vfs_view:
+                vfs_data = self.get_vfs_data(vfs_view)
+
+                manifest_start, manifest_end = vfs_data[self.MANIFEST_PATH_HASH]
+                filenames = read_strtab(io.BytesIO(vfs_view[manifest_start:manifest_end]))
+
+                # Files are independent of each other, so let a pool of threads
+                # write them while we carry on walking the manifest
+                with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                    futures = []
+                    # Archives keep many files in few directories, only create
+                    # each of them once
+                    created_dirs = set()
+                    for fname in filenames:
+                        self.log('Extracting:', fname)
+
+                        file_start, file_end = vfs_data[self.hash(fname)]
+
+                        # Names come straight from the archive, don't let them
+                        # point outside of root
+                        path = os.path.normpath(fname)
+                        if os.path.isabs(path) or path == os.pardir \
+                           or path.startswith(os.pardir + os.sep):
+                            die('Refusing to extract %s outside of the destination directory' % fname)
+
+                        dirname = os.path.dirname(path)
+                        if dirname != '' and dirname not in created_dirs:
+                            os.makedirs(pjoin(root, dirname), exist_ok=True)
+                            created_dirs.add(dirname)
+
+                        if opener is None:
+                            path = pjoin(root, path)
+
+                        futures.append(executor.submit(self.write_file, path,
+                                                       vfs_view[file_start:file_end],
+                                                       opener))
+
+                    for future in futures:
+                        future.result()
+        finally:
+            if root_fd is not None:
+                os.close(root_fd)
+            if isinstance(vfs_buf, mmap.mmap):
+                vfs_buf.close()
 
         return filenames
 
+    @staticmethod
+    def write_file(path, data, opener=None):
+        with open(path, 'wb', opener=opener) as fd:
+            fd.write(data)
+
     # A simple hashing algorithm
     @staticmethod
     def hash(string):
         acc = 0x1505
-        for c in bytes(string, 'ascii'):
-            acc += c + (acc << 5)
-            # Keep it 32-bit
-            acc &= 0xffffffff
+        for c in string.encode('ascii'):
+            # Same as acc + (acc << 5) + c, kept 32-bit
+            acc = (acc * 33 + c) & 0xffffffff
         return acc
 
 # Chdir to dir, execute func, then go back
@@ -1306,6 +1721,46 @@ def chdir_wrap(dir, func):
     os.chdir(prev_dir)
     return ret
 
+"""
+    Returns the instance of proc_cls, constructing it only on first use
+    Processors don't keep any state between targets, so a single instance
+    is shared by every job that runs in this process.
+"""
+@functools.lru_cache(maxsize=None)
+def get_processor(proc_cls, quiet):
+    return proc_cls(quiet=quiet)
+
+"""
+    Assembles or disassembles a batch of targets of a processor inside
+    base_dir
+
+    This is what the worker processes of HL5Tool run, every target is
+    independent of the others so they can be processed in parallel.
+    Returns the number of warnings issued while processing the targets.
+"""
+def run_processor_job(proc_cls, action, targets, base_dir, quiet):
+    def run():
+        for target in targets:
+            if action == 'assemble':
+                proc._assemble_target(target)
+            else:
+                proc._disassemble_target(target)
+
+    prev_n_warn = n_warn
+
+    # A forked worker inherits whatever the parent had yet to print,
+    # drop it so that it isn't printed twice
+    _log_buf.clear()
+
+    proc = get_processor(proc_cls, quiet)
+    try:
+        chdir_wrap(base_dir, run)
+    finally:
+        # Worker processes don't run exit handlers
+        flush_log()
+
+    return n_warn - prev_n_warn
+
 class HL5Tool:
     processors = [
         CommonTextProcessor,
@@ -1319,21 +1774,63 @@ class HL5Tool:
         GbmProcessor
     ]
 
-    def __init__(self, vfs_fd, base_dir, quiet=False):
+    # Maximum number of targets handled by a worker process at once
+    JOB_BATCH_SIZE = 16
+
+    def __init__(self, vfs_fd, base_dir, quiet=False, jobs=None):
         self.vfs_fd = vfs_fd
         self.base_dir = base_dir
         self.quiet = quiet
+        self.jobs = jobs if jobs else os.cpu_count()
+        # Directories that get_dir already made sure exist
+        self.dirs = {}
 
         mkdir(base_dir)
 
     def get_dir(self, dir_name='.'):
-        path = pjoin(self.base_dir, dir_name)
-        mkdir(path)
+        path = self.dirs.get(dir_name)
+        if path is None:
+            path = pjoin(self.base_dir, dir_name)
+            mkdir(path)
+            self.dirs[dir_name] = path
         return path
 
     def open_meta(self, mode):
         return open(pjoin(self.get_dir(), 'vfs.json'), mode)
 
+    def run_processors(self, action):
+        global n_warn
+
+        if self.jobs == 1:
+            for proc_cls in self.processors:
+                proc = get_processor(proc_cls, self.quiet)
+                if action == 'assemble':
+                    chdir_wrap(self.base_dir, proc._assemble)
+                else:
+                    chdir_wrap(self.base_dir, proc._disassemble)
+            return
+
+        # Split the targets into small batches, to cut down on the number of
+        # round trips to the workers while still spreading the work evenly
+        base_dir = os.path.abspath(self.base_dir)
+        jobs = []
+        for proc_cls in self.processors:
+            target_list = get_processor(proc_cls, self.quiet).target_list
+            for i in range(0, len(target_list), self.JOB_BATCH_SIZE):
+                jobs.append((proc_cls, action,
+                             target_list[i:i + self.JOB_BATCH_SIZE],
+                             base_dir, self.quiet))
+
+        # Print pending messages before the workers get forked
+        flush_log()
+        # Workers aren't guaranteed to inherit where the log goes
+        initializer = log_to_stderr if log_fd is sys.stderr else None
+        with ProcessPoolExecutor(max_workers=self.jobs,
+                                 initializer=initializer) as executor:
+            futures = [executor.submit(run_processor_job, *job) for job in jobs]
+            for future in futures:
+                n_warn += future.result()
+
     def extract(self, raw_only=False):
         # Prepare meta information
         meta = {
@@ -1344,17 +1841,14 @@ class HL5Tool:
             json.dump(meta, fd)
 
         # Extract VFS
-        vfs_proc = VFSProcessor(quiet=self.quiet)
-        chdir_wrap(self.get_dir('raw'),
-                   lambda: vfs_proc.disassemble(self.vfs_fd))
+        vfs_proc = VFSProcessor(quiet=self.quiet, jobs=self.jobs)
+        vfs_proc.disassemble(self.vfs_fd, self.get_dir('raw'))
 
         # Don't decompile anything if not requested
         if raw_only:
             return
 
-        for proc in self.processors:
-            proc = proc(quiet=self.quiet)
-            chdir_wrap(self.base_dir, proc._disassemble)
+        self.run_processors('disassemble')
 
     def create(self):
         with self.open_meta('r') as fd:
@@ -1365,27 +1859,26 @@ class HL5Tool:
             raw_only = meta['raw_only']
 
         if raw_only:
-            vfs_proc = VFSProcessor(quiet=self.quiet)
-            chdir_wrap(self.get_dir('raw'),
-                       lambda: vfs_proc.assemble(self.vfs_fd))
+            vfs_proc = VFSProcessor(quiet=self.quiet, jobs=self.jobs)
+            vfs_proc.assemble(self.vfs_fd, self.get_dir('raw'))
         else:
             # Make a copy of the raw directory.
             # Later, we will replace some of the files with our newly assembled files.
+            # The copy is made of hard links, as most of the files are left
+            # untouched and there's no need to duplicate their content.
             #
             # TODO: This removes everything under .tmp and it's dangerous.
             #       Fuck user's files if they happens to be there.
-            if os.path.exists(self.get_dir('.tmp')):
-                shutil.rmtree(self.get_dir('.tmp'))
-            shutil.copytree(self.get_dir('raw'), self.get_dir('.tmp'),
-                            dirs_exist_ok=True)
+            tmp_dir = pjoin(self.base_dir, '.tmp')
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            shutil.copytree(self.get_dir('raw'), tmp_dir,
+                            copy_function=link_or_copy)
 
-            for proc in self.processors:
-                proc = proc(quiet=self.quiet)
-                chdir_wrap(self.base_dir, proc._assemble)
+            self.run_processors('assemble')
 
-            vfs_proc = VFSProcessor(quiet=self.quiet)
-            chdir_wrap(self.get_dir('.tmp'),
-                       lambda: vfs_proc.assemble(self.vfs_fd))
+            vfs_proc = VFSProcessor(quiet=self.quiet, jobs=self.jobs)
+            vfs_proc.assemble(self.vfs_fd, tmp_dir)
 
 def print_version():
     # Version information
@@ -1400,6 +1893,10 @@ def print_version():
 
 
 def main():
+    # Version queries don't need the argument parser to be set up
+    if sys.argv[1:] in (['-v'], ['--version']):
+        print_version()
+
     parser = argparse.ArgumentParser(
         description=PROG_DESC,
         formatter_class=argparse.RawTextHelpFormatter,
@@ -1415,6 +1912,8 @@ def main():
                         help='only extract raw files')
     parser.add_argument('-q', '--quiet', action='store_true',
                         help='do not log anything except warnings and errors')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='process up to N resource files in parallel (defaults to the number of CPUs)')
     parser.add_argument('-v', '--version', action='store_true',
                         help='output version information and exit')
     parser.add_argument('dir', nargs='?',
@@ -1428,30 +1927,44 @@ def main():
     if args.extract and args.create:
         die('You may not specify more than one actions (-xc)')
 
+    if args.jobs is not None and args.jobs < 1:
+        die('Number of jobs must be at least 1')
+
+    archive_path = args.file
+    base_dir = os.getcwd() if args.dir is None else args.dir
+
+    # Archives are read and written with a large buffer to cut down on
+    # the number of syscalls
     if args.extract:
-        if args.file == None:
-            vfs_fd = sys.stdin
+        if archive_path is None:
+            vfs_fd = open(sys.stdin.fileno(), 'rb', buffering=COPY_BUFSIZE,
+                          closefd=False)
         else:
-            vfs_fd = open(args.file, 'rb')
+            vfs_fd = open(archive_path, 'rb', buffering=COPY_BUFSIZE,
+                          opener=noatime_opener)
+        advise_sequential(vfs_fd)
     elif args.create:
-        if args.file == None:
-            vfs_fd = sys.stdout
+        if archive_path is None:
+            # Keep progress messages out of the archive
+            log_to_stderr()
+            vfs_fd = open(sys.stdout.fileno(), 'wb', buffering=COPY_BUFSIZE,
+                          closefd=False)
         else:
-            vfs_fd = open(args.file, 'wb')
+            vfs_fd = open(archive_path, 'wb', buffering=COPY_BUFSIZE)
     else:
         parser.print_help()
         die()
 
-    base_dir = os.getcwd() if args.dir == None else args.dir
-
-    tool = HL5Tool(vfs_fd, base_dir, quiet=args.quiet)
+    tool = HL5Tool(vfs_fd, base_dir, quiet=args.quiet, jobs=args.jobs)
     if args.create:
         tool.create()
+        vfs_fd.flush()
     elif args.extract:
         tool.extract(raw_only=args.raw)
 
+    flush_log()
     if n_warn:
-        print('Program finished with %d warning(s)' % n_warn)
+        print('Program finished with %d warning(s)' % n_warn, file=log_fd)
 
 if __name__ == "__main__":
     main()